@@ -1,7 +1,6 @@
 import csv
-from itertools import islice
-from dataclasses import dataclass
-from collections import defaultdict, Counter
+from dataclasses import dataclass, field
+from collections import defaultdict, Counter, deque
 import matplotlib.pyplot as plt
 import numpy as np
 from urllib.parse import urlparse
@@ -10,12 +9,16 @@ from spotipy.oauth2 import SpotifyClientCredentials
 import os
 from dotenv import load_dotenv
 from matplotlib_venn import venn2
-from difflib import SequenceMatcher
-from wordcloud import WordCloud
+from rapidfuzz import fuzz, process
+from wordcloud import WordCloud, STOPWORDS
 import lyricsgenius
 import time
+import threading
 import re
+import sqlite3
 from pathlib import Path
+from functools import lru_cache
+from concurrent.futures import ThreadPoolExecutor
 
 
 forbidden_words = {'remastered', 'remaster', 'chorus', 'verse', '',
@@ -27,12 +30,21 @@ forbidden_words = {'remastered', 'remaster', 'chorus', 'verse', '',
     "just","very","literally","actually","basically","kinda","sorta", 'la'
 }
 
+# WordCloud.generate() used to apply its own STOPWORDS; generate_from_frequencies() doesn't
+_cloud_stopwords = frozenset(forbidden_words | STOPWORDS)
+
+_rng = np.random.default_rng()
+
 @dataclass(frozen=True, slots=True)
 class Song:
     title: str
     artist: str
     album: str
     duration: int # seconds
+    title_lc: str = field(init=False, repr=False, compare=False)
+
+    def __post_init__(self):
+        object.__setattr__(self, 'title_lc', self.title.lower())
 
     @classmethod
     def create(cls, title: str, artist: str, album: str, duration:str| int) -> "Song":
@@ -51,9 +63,14 @@ class Song:
     def __eq__(self, that):
         """Returns true if songs are effectively equal. Intentionally week to account for title variants of the same song.
         """
-        a = self.title.lower()
-        b = that.title.lower()
-        return SequenceMatcher(None, a.lower(), b.lower()).ratio() >= 0.8
+        a, b = self.title_lc, that.title_lc
+        if a == b:
+            return True
+        # ratio is at most 2*min(la, lb) / (la + lb), so skip pairs that can't reach 0.8
+        la, lb = len(a), len(b)
+        if 2 * min(la, lb) < 0.8 * (la + lb):
+            return False
+        return fuzz.ratio(a, b, score_cutoff=80) > 0
 
         # title_match = self.title == that.title
         # artist_match = self.artist == that.artist
@@ -76,10 +93,10 @@ class Playlist():
         return len(self.songs)
 
     def duration_box(self):
-        durations = [s.duration for s in self.songs]
+        durations = np.fromiter((s.duration for s in self.songs), dtype=np.int32, count=len(self.songs))
         fig, ax = plt.subplots(figsize=(5,5))
         ax.boxplot(durations, vert=True)
-        jitter = np.random.normal(1, 0.02, size=len(durations))
+        jitter = 1 + _rng.standard_normal(len(durations)) * 0.02
         ax.scatter(jitter, durations, alpha=0.2, color='blue', s=4, label='Individual Songs')
 
         ax.set_title(f'{self.tag} Song Duration Distribution')
@@ -90,25 +107,22 @@ class Playlist():
         fig.savefig(f'{self.tag}_duration_box.png', dpi=300)
         plt.close(fig)
 
-    def artist_frequency_dist(self, freq = False):
-        songs_by_artist = defaultdict(list)
-        for s in self.songs:
-            songs_by_artist[s.artist].append(s)
-
-        assert sum(len(j) for i,j in songs_by_artist.items()) == len(self.songs)
-
-        counts = {artist: len(lst) for artist, lst in songs_by_artist.items()}
-        artists_sorted = sorted(counts, key=counts.get)
+    def artist_frequency_dist(self, freq = False, top = 50):
+        counts = Counter(s.artist for s in self.songs)
+        assert counts.total() == len(self.songs)
 
         if freq:
             out_path = 'artist_frequency_bar.png'
             fig, ax = plt.subplots(figsize=(20, 10))
+            # only the most frequent artists, one label each is unreadable past a few dozen
+            artists_sorted = [a for a, _ in counts.most_common(top)][::-1]
             freqs_sorted   = [counts[a] for a in artists_sorted]
             ax.bar(artists_sorted, freqs_sorted)
             ax.set_ylabel("Number of songs")
             ax.set_xlabel("Artist")
-            ax.set_title(f"{self.tag} Songs per artist (ascending)")
-            ax.set_xticklabels(artists_sorted, rotation=45, ha="right", fontsize=6)
+            ax.set_title(f"{self.tag} Songs per artist, top {len(artists_sorted)} (ascending)")
+            ax.tick_params(axis="x", labelrotation=45, labelsize=6)
+            plt.setp(ax.get_xticklabels(), ha="right")
 
         else:
             out_path = 'artist_frequency_dist.png'
@@ -132,19 +146,16 @@ class Playlist():
 
 
 def parse_filepath(file_path:str) -> Playlist:
-    songs = []
     with open(file_path, newline="", encoding="utf-8") as f:
-        while True:
-            song_chunk = list(islice(f, 5))
-            if not song_chunk:
-                break
-            song_chunk = [line.strip() for line in song_chunk if line.strip()]
+        lines = [line for line in map(str.strip, f) if line]
 
-            if len(song_chunk) != 5:
-                raise ValueError(f"Malformed entry: {song_chunk}")
+    if len(lines) % 5:
+        raise ValueError(f"Malformed entry: {lines[-(len(lines) % 5):]}")
 
-            track_no, title, artist, album, duration = song_chunk
-            songs.append(Song.create(title, artist, album, duration))
+    songs = []
+    for i in range(0, len(lines), 5):
+        track_no, title, artist, album, duration = lines[i:i+5]
+        songs.append(Song.create(title, artist, album, duration))
     return Playlist(songs)
 
 def parse_spotify_url(playlist_url:str, tag='') -> Playlist:
@@ -156,16 +167,23 @@ def parse_spotify_url(playlist_url:str, tag='') -> Playlist:
         )
     )
 
-    songs = []
-
-    offset = 0
-    while True:
-        page = sp.playlist_items(
+    def fetch_page(offset):
+        return sp.playlist_items(
             playlist_url,
             offset=offset,
             limit=100,
             additional_types=["track"],  # ignore podcasts
+            fields="total,items(track(name,artists(name),album(name),duration_ms))",
         )
+
+    # first page tells us the total, the rest can be fetched concurrently
+    first = fetch_page(0)
+    offsets = range(len(first["items"]), first["total"], 100)
+    with ThreadPoolExecutor(max_workers=8) as pool:
+        pages = [first, *pool.map(fetch_page, offsets)]
+
+    songs = []
+    for page in pages:
         for item in page["items"]:
             t = item["track"]
             songs.append(
@@ -173,22 +191,38 @@ def parse_spotify_url(playlist_url:str, tag='') -> Playlist:
                     t["name"],
                     ", ".join(a["name"] for a in t["artists"]),
                     t["album"]["name"],
-                    int(t["duration_ms"]/1000)
+                    t["duration_ms"] // 1000
                 )
             )
-        offset += len(page["items"])
-        if offset >= page["total"]:
-            break
 
     return Playlist(songs, tag=tag)
 
 def playlist_intersection(playlist_1: Playlist, playlist_2: Playlist) -> Playlist:
-    song_intersection = []
-    for s1 in playlist_1:
-        for s2 in playlist_2:
-            if s1 == s2:
-                song_intersection.append(s1)
+    # block on title length: a ratio >= 0.8 needs 2*min(la, lb) >= 0.8*(la + lb),
+    # i.e. lb in [2*la/3, 3*la/2], so only those length buckets are compared
+    rows_by_len = defaultdict(list)
+    for i, s in enumerate(playlist_1):
+        rows_by_len[len(s.title_lc)].append(i)
+    cols_by_len = defaultdict(list)
+    for j, s in enumerate(playlist_2):
+        cols_by_len[len(s.title_lc)].append(j)
+
+    pairs = []
+    for la, rows in rows_by_len.items():
+        cols = [j for lb in range((2*la + 2) // 3, 3*la // 2 + 1) for j in cols_by_len.get(lb, ())]
+        if not cols:
+            continue
+        # same metric as Song.__eq__, scored for the whole block in one C call
+        matches = process.cdist(
+            [playlist_1.songs[i].title_lc for i in rows],
+            [playlist_2.songs[j].title_lc for j in cols],
+            scorer=fuzz.ratio,
+            score_cutoff=80,
+        )
+        pairs.extend((rows[r], cols[c]) for r, c in np.argwhere(matches > 0))
 
+    pairs.sort()
+    song_intersection = [playlist_1.songs[i] for i, _ in pairs]
     return Playlist(song_intersection, tag='intersect')
 
 
@@ -200,42 +234,141 @@ def visualize_intersection_venn(len_s1:int, len_s2:int, len_intersection:int) ->
     plt.savefig("playlist_intersection_venn.png", dpi=300)
     plt.savefig('intersect.png', dpi=300)
 
+_filename_rx = re.compile(r"[^-\w\s]")
+_word_rx = re.compile(r"[^\w\s]+")
+
+@lru_cache(maxsize=4096)
 def _sanitize(text: str) -> str:
     """Make an OS-safe, case-insensitive slug."""
-    _filename_rx = re.compile(r"[^-\w\s]")
     return _filename_rx.sub("", text).strip().replace(" ", "_").lower()
 
-def get_lyrics(song: Song, genius: lyricsgenius) -> str:
-    folder = Path("lyrics_cache")
-    folder.mkdir(exist_ok=True)
-    fname = f"{_sanitize(song.artist)}-{_sanitize(song.title)}.txt"
-    cache_path = folder / fname
-
-    if cache_path.exists():
-        print(f'{song} in cache')
-        return cache_path.read_text(encoding="utf-8")
-    try:
-        result = genius.search_song(title=song.title, artist=song.artist, get_full_info=False)
-        time.sleep(15)
+class RateLimiter():
+    """Sliding window rate limiter, used as a context manager around each call."""
+    def __init__(self, calls_per_minute:int):
+        self.calls_per_minute = calls_per_minute
+        self._calls = deque()
+        self._blocked_until = 0.0
+        self._lock = threading.Lock()
+
+    def pause(self, seconds:float) -> None:
+        """Hold back every caller for seconds, e.g. after the server answers 429."""
+        with self._lock:
+            self._blocked_until = max(self._blocked_until, time.monotonic() + seconds)
+
+    def __enter__(self):
+        while True:
+            with self._lock:
+                now = time.monotonic()
+                while self._calls and now - self._calls[0] >= 60:
+                    self._calls.popleft()
+                if now < self._blocked_until:
+                    wait = self._blocked_until - now
+                elif len(self._calls) < self.calls_per_minute:
+                    self._calls.append(now)
+                    return self
+                else:
+                    wait = 60 - (now - self._calls[0])
+            time.sleep(wait)
+
+    def __exit__(self, *exc):
+        return False
+
+_lyrics_db = Path("lyrics.db")
+_legacy_lyrics_dir = Path("lyrics_cache")  # one .txt per song, imported into _lyrics_db
+_db_lock = threading.Lock()
+_db = None
+_genius_limiter = RateLimiter(calls_per_minute=30)
+_genius_retries = 5
+
+# lyricsgenius 3.15 reports a non-200 reply as
+# AssertionError("Unexpected response status code: 429. ... Response headers: {'Retry-After': '7', ...}.")
+_retry_after_rx = re.compile(r"'retry-after': '(\d+)'", re.IGNORECASE)
+
+def _is_rate_limited(e: Exception) -> bool:
+    return isinstance(e, AssertionError) and "status code: 429" in str(e)
+
+def _retry_after(e: Exception, attempt:int) -> float:
+    """Seconds to wait after a 429, from Retry-After when present, else exponential backoff."""
+    match = _retry_after_rx.search(str(e))
+    return float(match.group(1)) if match else 2 ** attempt
+
+def _lyrics_conn() -> sqlite3.Connection:
+    """Shared lyrics cache connection, opened on first use. Call with _db_lock held."""
+    global _db
+    if _db is None:
+        conn = sqlite3.connect(_lyrics_db, check_same_thread=False)
+        conn.execute("CREATE TABLE IF NOT EXISTS lyrics(k TEXT PRIMARY KEY, v TEXT)")
+        if conn.execute("SELECT 1 FROM lyrics LIMIT 1").fetchone() is None and _legacy_lyrics_dir.is_dir():
+            conn.executemany(
+                "INSERT OR IGNORE INTO lyrics VALUES (?, ?)",
+                ((p.stem, p.read_text(encoding="utf-8")) for p in _legacy_lyrics_dir.glob("*.txt")),
+            )
+        conn.commit()
+        _db = conn
+    return _db
+
+def _cache_key(song: Song) -> str:
+    return f"{_sanitize(song.artist)}-{_sanitize(song.title)}"
+
+def _read_cache(song: Song) -> str | None:
+    """Cached lyrics for song, or None on a cache miss."""
+    with _db_lock:
+        row = _lyrics_conn().execute("SELECT v FROM lyrics WHERE k=?", (_cache_key(song),)).fetchone()
+    if row is None:
+        return None
+    print(f'{song} in cache')
+    return row[0]
+
+def _write_cache(song: Song, lyrics: str) -> None:
+    with _db_lock:
+        conn = _lyrics_conn()
+        conn.execute("INSERT OR REPLACE INTO lyrics VALUES (?, ?)", (_cache_key(song), lyrics))
+        conn.commit()
+
+def _fetch_genius(song: Song, genius: lyricsgenius) -> str:
+    """Fetch lyrics from Genius and cache them, rate limited by _genius_limiter."""
+    for attempt in range(_genius_retries):
+        try:
+            with _genius_limiter:
+                result = genius.search_song(title=song.title, artist=song.artist, get_full_info=False)
+        except Exception as e:
+            if _is_rate_limited(e):
+                # pauses every worker, not just this one; the retry waits in the limiter
+                _genius_limiter.pause(_retry_after(e, attempt))
+                continue
+            print(f"Error fetching lyrics for {song}: {e}")
+            return ""
+
         if result:
-            cache_path.write_text(result.lyrics, encoding="utf-8")
+            _write_cache(song, result.lyrics)
             return result.lyrics
-    except Exception as e:
-        print(f"Error fetching lyrics for {song}: {e}")
+        return ""
+
+    print(f"Error fetching lyrics for {song}: still rate limited after {_genius_retries} tries")
     return ""
 
+def get_lyrics(song: Song, genius: lyricsgenius) -> str:
+    lyrics = _read_cache(song)
+    if lyrics is None:
+        lyrics = _fetch_genius(song, genius)
+    return lyrics
+
 def wordCloud(playlist: Playlist, genius:lyricsgenius) -> None:
-    text = ''
-    for i in playlist:
-        lyrics = get_lyrics(i, genius)
-        words = lyrics.split()
-        for w in words:
-            # w = w.strip().lower()
-            w = re.sub(r"[^\w]", "", w).lower()
-            if w not in forbidden_words:
-                text += f' { w}'
-
-    wc = WordCloud(width=800, height=400, background_color='white').generate(text)
+    songs = list(playlist)
+    all_lyrics = [_read_cache(s) for s in songs]
+
+    # only cache misses go to Genius
+    missing = [s for s, lyrics in zip(songs, all_lyrics) if lyrics is None]
+    with ThreadPoolExecutor(max_workers=4) as pool:
+        fetched = iter(list(pool.map(lambda s: _fetch_genius(s, genius), missing)))
+    all_lyrics = [next(fetched) if lyrics is None else lyrics for lyrics in all_lyrics]
+
+    tokens = []
+    for lyrics in all_lyrics:
+        clean = _word_rx.sub("", lyrics.lower())
+        tokens.extend(w for w in clean.split() if w not in _cloud_stopwords and not w.isdigit())
+
+    wc = WordCloud(width=800, height=400, background_color='white').generate_from_frequencies(Counter(tokens))
 
     plt.figure(figsize=(10, 5))
     plt.imshow(wc, interpolation='bilinear')